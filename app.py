@@ -1,22 +1,53 @@
 import streamlit as st
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import datetime
+import hashlib
 import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
 import time
+import uuid
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# --- Page Configuration ---
-st.set_page_config(
-    page_title="Knowledge Base",
-    page_icon="🧠",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+SYSTEM_PROMPT = """INSTRUCTIONS:
+1. You are a Knowledge Base Assistant.
+2. Answer the user's question STRICTLY based on the provided documents.
+3. Do NOT use outside knowledge or general training data.
+4. If the answer cannot be found in the documents, politely state that the information is not present in the files.
+5. Cite the document name if possible.
+"""
 
-# --- Custom Styling ---
-st.markdown("""
+# Flash-Lite first: higher rate limits and lower latency for Q&A over the documents
+MODEL_OPTIONS = ["gemini-2.5-flash-lite", "gemini-2.5-flash", "gemini-2.5-pro"]
+# Requests per minute allowed for each model (free-tier quotas)
+MODEL_RPM = {"gemini-2.5-flash-lite": 15, "gemini-2.5-flash": 10, "gemini-2.5-pro": 5}
+# How long an explicit context cache lives on Gemini without being used, per chat mode.
+# The full document set is expensive to re-cache, so it is kept longer.
+CACHE_TTL = {
+    "Single Document": datetime.timedelta(minutes=10),
+    "All Documents": datetime.timedelta(hours=1),
+}
+# Max user/assistant exchanges sent to the model (the UI keeps the full history).
+# Once exceeded, history is cut back to half so the prompt prefix stays stable between cuts.
+MAX_CONTEXT_TURNS = 20
+# Files uploaded to Gemini at the same time
+UPLOAD_WORKERS = 4
+# Chat history, the upload cache and each session's active file survive restarts here
+DB_PATH = "knowledge_base.db"
+# Most recent messages kept in a session (older ones stay in the database)
+HISTORY_LOAD_LIMIT = 200
+
+CUSTOM_CSS = """
 <style>
     .main-header {
         font-family: 'Inter', sans-serif;
@@ -50,17 +81,313 @@ st.markdown("""
         border: 1px dashed #4285F4;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+# --- Page Configuration ---
+st.set_page_config(
+    page_title="Knowledge Base",
+    page_icon="🧠",
+    layout="wide",
+    initial_sidebar_state="expanded"
+)
+
+# --- Custom Styling ---
+# Streamlit drops elements a rerun does not re-emit, so this is sent every run
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+
+# --- Persistence ---
+@st.cache_resource
+def get_db():
+    """Open the SQLite store shared by all sessions."""
+    # Autocommit: every statement is its own transaction, safe to share across script threads
+    db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS chat_messages (session_id TEXT, role TEXT, message TEXT, ts REAL);
+        CREATE INDEX IF NOT EXISTS chat_messages_session ON chat_messages (session_id);
+        CREATE TABLE IF NOT EXISTS gemini_uploads (
+            api_key_hash TEXT, file_key TEXT, file_name TEXT, PRIMARY KEY (api_key_hash, file_key)
+        );
+        CREATE TABLE IF NOT EXISTS session_files (session_id TEXT PRIMARY KEY, file_name TEXT);
+    """)
+    return db
+
+def add_message(role, message):
+    """Append a message to the chat and persist it, keeping only recent messages in memory."""
+    st.session_state.chat_history.append((role, message))
+    del st.session_state.chat_history[:-HISTORY_LOAD_LIMIT]
+    get_db().execute(
+        "INSERT INTO chat_messages VALUES (?, ?, ?, ?)",
+        (st.session_state.session_id, role, message, time.time()),
+    )
+
+def set_current_file(gemini_file):
+    """Make gemini_file the session's active document and persist the choice."""
+    st.session_state.current_file_uri = gemini_file
+    get_db().execute(
+        "INSERT OR REPLACE INTO session_files VALUES (?, ?)",
+        (st.session_state.session_id, gemini_file.name),
+    )
 
 # --- Session State Management ---
+if "session_id" not in st.session_state:
+    # Kept in the URL so a reload (or a restarted server) resumes the same chat.
+    # The ID is the only thing guarding the transcript: anyone with the URL can read and continue it.
+    sid = st.query_params.get("sid", "")
+    st.session_state.session_id = sid if re.fullmatch(r"[0-9a-f]{32}", sid) else uuid.uuid4().hex
+    st.query_params["sid"] = st.session_state.session_id
 if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
-if "uploaded_files_cache" not in st.session_state:
-    st.session_state.uploaded_files_cache = {}
-if "current_file_uri" not in st.session_state:
-    st.session_state.current_file_uri = None
+    rows = get_db().execute(
+        "SELECT role, message FROM chat_messages WHERE session_id = ? ORDER BY rowid DESC LIMIT ?",
+        (st.session_state.session_id, HISTORY_LOAD_LIMIT),
+    ).fetchall()
+    st.session_state.chat_history = rows[::-1]
+if "gemini_cache" not in st.session_state:
+    st.session_state.gemini_cache = {}  # chat mode -> key of the shared context cache in use
+if "chat_session" not in st.session_state:
+    st.session_state.chat_session = None  # (context_key, ChatSession)
+
+# --- Model ---
+@st.cache_resource(show_spinner=False)
+def get_model(api_key_hash, model_name):
+    """Build a GenerativeModel once per API key/model and reuse it across reruns."""
+    return genai.GenerativeModel(model_name, system_instruction=SYSTEM_PROMPT)
+
+# --- Remote Files ---
+@st.cache_resource(ttl=60, show_spinner=False)
+def list_remote_files(api_key_hash):
+    """List files on the Gemini server, cached per API key so reruns don't hit the network."""
+    return list(genai.list_files())
+
+# --- Uploads ---
+def wait_for_file(gemini_file, timeout=120):
+    """Poll until the file leaves PROCESSING, backing off from 250 ms up to 2 s between checks."""
+    deadline = time.monotonic() + timeout
+    delay = 0.25
+    while gemini_file.state.name == "PROCESSING":
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{gemini_file.display_name} was still processing after {timeout}s")
+        time.sleep(delay)
+        delay = min(delay * 1.6, 2.0)
+        gemini_file = genai.get_file(gemini_file.name)
+    return gemini_file
+
+def upload_and_wait(uploaded_file):
+    """Upload a Streamlit file to Gemini via a temp copy and wait until it is processed."""
+    # Stream to the system temp dir in 1 MB chunks instead of copying the whole buffer;
+    # keep the extension so the SDK can guess the MIME type
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as f:
+        shutil.copyfileobj(uploaded_file, f, length=1024 * 1024)
+        temp_filename = f.name
+    
+    try:
+        gemini_file = genai.upload_file(path=temp_filename, display_name=uploaded_file.name)
+        return wait_for_file(gemini_file)
+    finally:
+        os.unlink(temp_filename)
+
+# --- Upload Deduplication ---
+def remember_uploaded_file(api_key_hash, file_key, file_name):
+    """Record which Gemini file holds this content for this API key."""
+    get_db().execute(
+        "INSERT OR REPLACE INTO gemini_uploads VALUES (?, ?, ?)", (api_key_hash, file_key, file_name)
+    )
+
+def find_uploaded_file(api_key_hash, file_key):
+    """Return the Gemini file already holding this content for this API key, if it is still ACTIVE."""
+    row = get_db().execute(
+        "SELECT file_name FROM gemini_uploads WHERE api_key_hash = ? AND file_key = ?", (api_key_hash, file_key)
+    ).fetchone()
+    if not row:
+        return None
+    file_name = row[0]
+    try:
+        gemini_file = genai.get_file(file_name)
+        if gemini_file.state.name == "ACTIVE":
+            return gemini_file
+    except (google_exceptions.NotFound, google_exceptions.PermissionDenied):
+        pass  # Expired or deleted on the server
+    except google_exceptions.GoogleAPICallError:
+        return None  # Transient; upload again but keep the record
+    get_db().execute(
+        "DELETE FROM gemini_uploads WHERE api_key_hash = ? AND file_key = ?", (api_key_hash, file_key)
+    )
+    return None
+
+def restore_current_file():
+    """Reload the session's active document after a restart, if it still exists on the server."""
+    row = get_db().execute(
+        "SELECT file_name FROM session_files WHERE session_id = ?", (st.session_state.session_id,)
+    ).fetchone()
+    if not row:
+        return
+    try:
+        st.session_state.current_file_uri = genai.get_file(row[0])
+    except (google_exceptions.NotFound, google_exceptions.PermissionDenied):
+        get_db().execute("DELETE FROM session_files WHERE session_id = ?", (st.session_state.session_id,))
+    except google_exceptions.GoogleAPICallError:
+        pass  # Transient; start without an active file rather than failing the page
+
+# --- Context Caching ---
+@st.cache_resource
+def get_cache_registry():
+    """Context caches shared by all sessions and tabs: (api_key_hash, cache_key) -> CachedContent, or None if refused."""
+    return {}, collections.defaultdict(threading.Lock), threading.Lock()
+
+def drop_context_cache():
+    """Delete the context caches this session has been using."""
+    caches, _, _ = get_cache_registry()
+    for key in st.session_state.gemini_cache.values():
+        cache = caches.pop(key, None)
+        if cache:
+            try:
+                cache.delete()
+            except google_exceptions.GoogleAPICallError:
+                pass  # Already expired, or unreachable; the TTL cleans it up either way
+    st.session_state.gemini_cache = {}
+
+def get_context_cache(files, model_name, mode, api_key_hash):
+    """Return a CachedContent holding the files + instructions, shared with any session using the same key and files.
+
+    Returns None when Gemini won't cache this content, so the caller sends the files inline instead.
+    """
+    cache_key = hashlib.sha256(
+        ("|".join(sorted(f.name for f in files)) + SYSTEM_PROMPT + model_name).encode()
+    ).hexdigest()
+    ttl = CACHE_TTL[mode]
+    key = (api_key_hash, cache_key)
+    st.session_state.gemini_cache[mode] = key
+
+    caches, key_locks, registry_lock = get_cache_registry()
+    with registry_lock:
+        key_lock = key_locks[key]
+    # Held across the API calls so two tabs don't both create a cache for the same documents
+    with key_lock:
+        if key in caches:
+            cache = caches[key]
+            if cache is None:
+                return None  # Already refused for these files; don't retry every turn
+            # Keep it alive while in use, but only spend a round-trip once half the TTL has passed
+            if cache.expire_time - datetime.datetime.now(datetime.timezone.utc) > ttl / 2:
+                return cache
+            try:
+                cache.update(ttl=ttl)
+                return cache
+            except google_exceptions.NotFound:
+                pass  # Expired on the server, recreate below
+
+        try:
+            cache = genai.caching.CachedContent.create(
+                model=f"models/{model_name}",
+                display_name=cache_key,
+                system_instruction=SYSTEM_PROMPT,
+                contents=files,
+                ttl=ttl,
+            )
+        except (google_exceptions.InvalidArgument, google_exceptions.PermissionDenied):
+            # Permanent refusal, e.g. below the minimum cacheable size: remember it for these files
+            cache = None
+        except google_exceptions.GoogleAPICallError:
+            caches.pop(key, None)
+            return None  # Transient (unavailable, timeout, 429): send inline this turn, try caching again next turn
+        caches[key] = cache
+        return cache
+
+# --- Chat Session ---
+def file_parts(files):
+    """Reference uploaded Gemini files as message parts."""
+    return [
+        genai.protos.Part(file_data=genai.protos.FileData(file_uri=f.uri, mime_type=f.mime_type))
+        for f in files
+    ]
+
+def to_content(role, text):
+    """Convert a chat_history entry into a Gemini Content message."""
+    return genai.protos.Content(role="model" if role == "assistant" else "user", parts=[genai.protos.Part(text=text)])
+
+def with_files(content, files):
+    """Return content with the uncached files attached in front of its parts."""
+    return genai.protos.Content(role=content.role, parts=file_parts(files) + list(content.parts))
+
+def history_contents(messages, files=()):
+    """Convert chat_history entries into alternating user/model Content, attaching uncached files to the first message."""
+    contents = []
+    for role, message in messages:
+        content = to_content(role, message)
+        if contents and contents[-1].role == content.role:
+            contents[-1] = content  # A failed turn left a user message without a reply
+        elif contents or content.role == "user":
+            contents.append(content)
+    if contents and contents[-1].role == "user":
+        contents.pop()  # Unanswered; the new prompt is sent next
+    if files and contents:
+        contents[0] = with_files(contents[0], files)
+    return contents
+
+def trim_history(history, files=()):
+    """Cut history back to the last MAX_CONTEXT_TURNS // 2 exchanges, re-attaching uncached files to the new first message."""
+    if len(history) <= MAX_CONTEXT_TURNS * 2:
+        return history
+    window = list(history[-(MAX_CONTEXT_TURNS // 2) * 2:])
+    if files:
+        window[0] = with_files(window[0], files)
+    return window
+
+# --- Rate Limiting ---
+@st.cache_resource
+def get_rate_buckets():
+    """Request timestamps of the last minute per (API key hash, model), shared by all sessions since quotas are per key."""
+    return collections.defaultdict(collections.deque), threading.Lock()
+
+def wait_for_rate_limit(api_key_hash, model_name, placeholder):
+    """Sleep until another request fits in the model's requests-per-minute quota for this API key."""
+    buckets, lock = get_rate_buckets()
+    while True:
+        with lock:
+            sent = buckets[(api_key_hash, model_name)]
+            now = time.monotonic()
+            while sent and now - sent[0] >= 60:
+                sent.popleft()
+            if len(sent) < MODEL_RPM[model_name]:
+                sent.append(now)
+                return
+            delay = 60 - (now - sent[0])
+        # Sleep outside the lock, then re-check: another session may take the freed slot first
+        placeholder.markdown(f"Waiting for rate limit… ({delay:.0f}s)")
+        time.sleep(delay)
+        placeholder.markdown("Thinking...")
+
+@retry(
+    retry=retry_if_exception_type(google_exceptions.ResourceExhausted),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+def send_message(chat, content, model_name, api_key_hash, placeholder):
+    """Send a streamed chat message, pacing to the model's RPM and retrying on 429s."""
+    wait_for_rate_limit(api_key_hash, model_name, placeholder)
+    return chat.send_message(content, stream=True)
+
+def stream_text(response, max_chunk=50, piece=4, max_delay=0.5):
+    """Yield the text of a streamed response, re-splitting oversized chunks so the UI types smoothly."""
+    for chunk in response:
+        if not chunk.parts:
+            continue  # e.g. the final chunk carrying only the finish reason
+        text = chunk.text
+        if len(text) <= max_chunk:
+            yield text
+            continue
+        # Spread a large chunk over at most max_delay seconds
+        pieces = [text[i:i + piece] for i in range(0, len(text), piece)]
+        delay = min(0.02, max_delay / len(pieces))
+        for p in pieces:
+            yield p
+            time.sleep(delay)
 
 # --- Sidebar ---
+if notice := st.session_state.pop("upload_notice", None):
+    st.toast(notice, icon="✅")
+
 with st.sidebar:
     st.markdown("### ⚙️ Configuration")
     
@@ -75,11 +402,17 @@ with st.sidebar:
 
     if api_key:
         genai.configure(api_key=api_key)
+        api_key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+        if "current_file_uri" not in st.session_state:
+            st.session_state.current_file_uri = None
+            restore_current_file()
         st.success("API Key configured!", icon="✅")
     else:
         st.warning("Please enter your API Key to proceed.", icon="⚠️")
         st.stop() # Stop if no key is present to prevent errors downstream
 
+    model_name = st.selectbox("Model", MODEL_OPTIONS, index=0, help="Flash-Lite has the highest rate limits; use Pro for complex questions")
+
     # --- Mode Selection ---
     st.markdown("### 🤖 Chat Mode")
     chat_mode = st.radio("Context:", ["Single Document", "All Documents"], index=0)
@@ -89,43 +422,64 @@ with st.sidebar:
         tab1, tab2 = st.tabs(["Upload New", "Select Existing"])
         
         with tab1:
-            uploaded_file = st.file_uploader("Upload a document", type=['pdf', 'txt', 'md', 'csv', 'json', 'py', 'js', 'html'])
-            if uploaded_file:
-                file_key = f"{uploaded_file.name}-{uploaded_file.size}"
+            uploaded_files = st.file_uploader("Upload documents", type=['pdf', 'txt', 'md', 'csv', 'json', 'py', 'js', 'html'], accept_multiple_files=True)
+            if uploaded_files:
                 if st.button("Upload to Gemini", key="upload_btn"):
-                    with st.spinner(f"Uploading {uploaded_file.name}..."):
+                    with st.spinner(f"Uploading {len(uploaded_files)} file(s)..."):
                         try:
-                            temp_filename = f"temp_{uploaded_file.name}"
-                            with open(temp_filename, "wb") as f:
-                                f.write(uploaded_file.getbuffer())
+                            # Uploads are network-bound, so run them side by side
+                            existing = []  # (uploaded_file, File already on the server)
+                            pending = []  # (uploaded_file, file_key, Future of its upload)
+                            found, submitted = {}, {}  # file_key -> File / Future, so identical files in a batch upload once
+                            with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+                                for uploaded_file in uploaded_files:
+                                    # Key by content, so same-named files don't collide and edited files re-upload
+                                    file_key = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+                                    if file_key in submitted:
+                                        pending.append((uploaded_file, file_key, submitted[file_key]))
+                                        continue
+                                    # Reuse an identical file that is already on the server
+                                    if file_key not in found:
+                                        found[file_key] = find_uploaded_file(api_key_hash, file_key)
+                                    if found[file_key] is not None:
+                                        existing.append((uploaded_file, found[file_key]))
+                                    else:
+                                        submitted[file_key] = executor.submit(upload_and_wait, uploaded_file)
+                                        pending.append((uploaded_file, file_key, submitted[file_key]))
                             
-                            gemini_file = genai.upload_file(path=temp_filename, display_name=uploaded_file.name)
+                            ready = [gemini_file for _, gemini_file in existing]
+                            for uploaded_file, file_key, future in pending:
+                                try:
+                                    gemini_file = future.result()
+                                except Exception as e:
+                                    st.error(f"Upload failed for {uploaded_file.name}: {str(e)}")
+                                    continue
+                                if gemini_file.state.name == "FAILED":
+                                    st.error(f"File processing failed: {uploaded_file.name}")
+                                else:
+                                    remember_uploaded_file(api_key_hash, file_key, gemini_file.name)
+                                    ready.append(gemini_file)
                             
-                            # Wait for processing
-                            while gemini_file.state.name == "PROCESSING":
-                                time.sleep(2)
-                                gemini_file = genai.get_file(gemini_file.name)
-                                
-                            if gemini_file.state.name == "FAILED":
-                                st.error("File processing failed.")
-                            else:
-                                st.session_state.current_file_uri = gemini_file
-                                st.success(f"Uploaded & Ready: {uploaded_file.name}")
-                                time.sleep(1)
-                                st.rerun()
-                                
-                            if os.path.exists(temp_filename):
-                                os.remove(temp_filename)
+                            if ready:
+                                set_current_file(ready[-1])
+                                list_remote_files.clear()  # Show the new files in the lists
+                                notice = f"Uploaded & Ready: {', '.join(f.display_name for f in ready)}"
+                                if len(ready) == len(uploaded_files):
+                                    # Shown as a toast after the rerun instead of sleeping so it stays visible
+                                    st.session_state.upload_notice = notice
+                                    st.rerun()
+                                st.success(notice)  # Keep the errors above on screen
                         except Exception as e:
                             st.error(f"Upload failed: {str(e)}")
 
         with tab2:
             if st.button("Refresh File List"):
+                list_remote_files.clear()
                 st.rerun()
                 
             try:
                 # List files from Gemini API
-                remote_files = list(genai.list_files())
+                remote_files = list_remote_files(api_key_hash)
                 if not remote_files:
                     st.info("No files found on Gemini server.")
                 else:
@@ -133,7 +487,7 @@ with st.sidebar:
                     selected_file_name = st.selectbox("Select a file", options=list(file_options.keys()))
                     
                     if st.button("Load Selected File"):
-                        st.session_state.current_file_uri = file_options[selected_file_name]
+                        set_current_file(file_options[selected_file_name])
                         st.success(f"Loaded: {selected_file_name}")
                         st.rerun()
             except Exception as e:
@@ -147,11 +501,15 @@ with st.sidebar:
         st.info("📚 **Global Context**: The model will read ALL uploaded files to answer your questions.")
         st.markdown("*(Note: This uses the large context window of Gemini 2.5)*")
         if st.button("Refresh Available Files"):
+            list_remote_files.clear()
             st.rerun()
 
     st.markdown("---")
     if st.button("Clear Chat History"):
         st.session_state.chat_history = []
+        get_db().execute("DELETE FROM chat_messages WHERE session_id = ?", (st.session_state.session_id,))
+        st.session_state.chat_session = None
+        drop_context_cache()
         st.rerun()
 
 # --- Main Interface ---
@@ -171,7 +529,12 @@ if chat_mode == "Single Document":
 else:
     # All Documents Mode
     try:
-        active_files = list(genai.list_files())
+        # list_files already reports each file's state, so no per-file get_file calls are needed
+        # Sorted so the files form the same prompt prefix on every turn (implicit caching)
+        active_files = sorted(
+            (f for f in list_remote_files(api_key_hash) if f.state.name == "ACTIVE"),
+            key=lambda f: f.name,
+        )
         if not active_files:
             st.warning("⚠️ No files found on the server. Please switch to 'Single Document' to upload some files first.")
             st.stop()
@@ -187,7 +550,7 @@ for role, message in st.session_state.chat_history:
 # Chat Input
 if prompt := st.chat_input("Ask something about your document(s)..."):
     # User Message
-    st.session_state.chat_history.append(("user", prompt))
+    add_message("user", prompt)
     with st.chat_message("user"):
         st.markdown(prompt)
         
@@ -197,37 +560,53 @@ if prompt := st.chat_input("Ask something about your document(s)..."):
         message_placeholder.markdown("Thinking...")
         
         try:
-            # Initialize model
-            model = genai.GenerativeModel('gemini-2.5-flash')
-            
-            # Context Preparation
-            # We pass the list of file objects (or URIs) directly to the model
-            # Note: active_files contains the file usage objects from list_files or upload
+            # Files + instructions live in an explicit cache so they aren't re-sent every turn
+            cache = get_context_cache(active_files, model_name, chat_mode, api_key_hash)
             
-            system_prompt = """
-            INSTRUCTIONS:
-            1. You are a Knowledge Base Assistant.
-            2. Answer the user's question STRICTLY based on the provided documents.
-            3. Do NOT use outside knowledge or general training data.
-            4. If the answer cannot be found in the documents, politely state that the information is not present in the files.
-            5. Cite the document name if possible.
-            """
+            if cache:
+                context_key = cache.name
+                inline_files = []
+            else:
+                context_key = model_name + ":" + "|".join(sorted(f.name for f in active_files))
+                inline_files = active_files
             
-            context_prompt = ""
-            for role, msg in st.session_state.chat_history[:-1]:
-                context_prompt += f"{role.upper()}: {msg}\n"
+            # Reuse the session's chat; rebuild it from the displayed history if the context changed
+            entry = st.session_state.chat_session
+            if not entry or entry[0] != context_key:
+                if cache:
+                    model = genai.GenerativeModel.from_cached_content(cached_content=cache)
+                else:
+                    model = get_model(api_key_hash, model_name)
+                history = history_contents(
+                    st.session_state.chat_history[-(MAX_CONTEXT_TURNS * 2 + 1):-1], inline_files
+                )
+                entry = (context_key, model.start_chat(history=history))
+                st.session_state.chat_session = entry
+            chat = entry[1]
             
-            final_prompt = f"{system_prompt}\n\n{context_prompt}\nUSER: {prompt}\nASSISTANT:"
+            # Bound what is sent each turn; trimming in blocks keeps the cached prefix stable in between
+            if len(chat.history) > MAX_CONTEXT_TURNS * 2:
+                chat.history = trim_history(chat.history, inline_files)
             
-            # Construct content list: [file1, file2, ..., prompt]
-            request_content = active_files + [final_prompt]
+            # Uncached files ride along with the first message of the conversation
+            if inline_files and not chat.history:
+                response = send_message(chat, inline_files + [prompt], model_name, api_key_hash, message_placeholder)
+            else:
+                response = send_message(chat, prompt, model_name, api_key_hash, message_placeholder)
             
-            response = model.generate_content(request_content)
+            # Render tokens as they arrive instead of waiting for the full answer
+            full_response = message_placeholder.write_stream(stream_text(response))
             
-            full_response = response.text
-            message_placeholder.markdown(full_response)
-            st.session_state.chat_history.append(("assistant", full_response))
+            # A stream cut short (e.g. RECITATION, SAFETY) doesn't raise, but leaves the chat unusable for the next turn
+            finish_reason = response.candidates[0].finish_reason if response.candidates else None
+            if finish_reason in (genai.protos.Candidate.FinishReason.STOP, genai.protos.Candidate.FinishReason.MAX_TOKENS):
+                add_message("assistant", full_response)
+            else:
+                st.session_state.chat_session = None  # Rebuild from chat_history, which skips the unanswered prompt
+                reason = finish_reason.name if finish_reason is not None else "no response"
+                st.warning(f"The answer was stopped early ({reason}) and was not saved. Try rephrasing your question.", icon="⚠️")
             
         except Exception as e:
+            st.session_state.chat_session = None  # Rebuild from chat_history on the next turn
             message_placeholder.error(f"An error occurred: {str(e)}")
 